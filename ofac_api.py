@@ -1,9 +1,17 @@
-﻿from flask import Flask, request, jsonify
+﻿from flask import Flask, request
+from flask.json.provider import JSONProvider
+import orjson
 import sqlite3
-import pandas as pd
 from pathlib import Path
 import logging
-from typing import List, Dict, Any, Optional
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import threading
+import functools
+import hashlib
+import re
+from typing import List, Dict, Any, Optional, Tuple
 
 """
 OFAC API (extended)
@@ -17,8 +25,14 @@ OFAC API (extended)
       city    : 都市名 (任意)
       limit   : 1‒1000  [default: 100]
       fuzzy   : true/false 類似度検索 (未実装 placeholder)
+      match   : contains | prefix   [default: contains]
+                contains = 各語の前方一致 (FTS5) / prefix = 値全体の前方一致 (大文字小文字無視)
  - 既存 `partyId` 取得エンドポイントは変更なし
+ - `/ofacParty/batch?ids=1,2,3` : 複数パーティの詳細を一括取得 (最大 500 件, 見つからない ID は null)
+ - `/ofacParty/lite?partyId=` : 種別と正式名称のみを返す軽量版 (スキャナ向け)
  - 後方互換: `name=` パラメータを許容 (scope=name)
+ - DB 更新の反映: 各ワーカーがリクエスト毎に DB ファイルの入れ替え / 更新を検知し、
+   検索テーブルの作り直し・接続の開き直し・キャッシュの破棄を自動で行う
 """
 
 # ──────────────────────────────────────────────
@@ -28,43 +42,268 @@ LOG_DIR = Path("logs")
 LOG_DIR.mkdir(exist_ok=True)
 LOG_FILE = LOG_DIR / "ofac_api.log"
 
+# ファイル / コンソールへの書き込みはバックグラウンドスレッド (QueueListener) で行い、
+# リクエスト処理スレッドはキューに積むだけにする
+_log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+_log_handlers = [
+    logging.FileHandler(LOG_FILE, encoding="utf-8"),
+    logging.StreamHandler()
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding="utf-8"),
-        logging.StreamHandler()
-    ]
+    format="%(message)s",  # 整形はリスナー側のハンドラで行う
+    handlers=[QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
 # ──────────────────────────────────────────────
 # Flask アプリ & DB ファイル
 # ──────────────────────────────────────────────
+
+class ORJSONProvider(JSONProvider):
+    """app.json (get_json など) のシリアライズを orjson (C 実装) に置き換える
+
+    ルートのレスポンスは _ok / _error が orjson で直接 bytes にする。
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 DB_FILE = Path("ofac_demo.db")
 
 # ──────────────────────────────────────────────
-# 共通ユーティリティ
+# DB 接続 (ワーカースレッド毎に共有)
 # ──────────────────────────────────────────────
+# リクエスト毎の connect / close をやめ、スレッド毎に開いた 1 本を使い回す。
+# SQLite のページキャッシュがリクエストを跨いで温まったまま残る。
+# hypercorn は WSGI アプリをスレッドプールで実行するため、接続をスレッド毎に
+# 持たせることでロック無しに並行して読み取れる (WAL なので読み取り同士は競合しない)。
+
+# 読み取り中心のワークロード向けチューニング (接続毎に 1 回だけ適用)
+#   WAL + NORMAL で読み取り時の fsync を避け、64MB のページキャッシュと
+#   256MB の mmap で頻出テーブルをメモリ上に載せたままにする
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+)
 
-def query_to_df(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> pd.DataFrame:
-    """SQL を実行し DataFrame で返す (0 行なら empty DataFrame)"""
-    return pd.read_sql_query(sql, conn, params=params)
+# 頻出の結合 / 絞り込み列に対するインデックス (起動時に無ければ作成)
+#   ofac_party_list_link / ofac_party_program_link は主キー (party_id, *_cd) が
+#   そのまま covering index になるため追加しない
+SCHEMA_INDEXES = (
+    ("idx_name_party",
+     "CREATE INDEX IF NOT EXISTS idx_name_party"
+     " ON ofac_party_name(party_id, is_primary_flg, name_type_cd, name_text)"),
+    # 別名は name_type_cd の表記揺れ ('AKA' / 'a.k.a.' 等) を式で吸収して引く。
+    # 元データは書き換えず、この式そのものを索引する
+    ("idx_name_party_alias",
+     "CREATE INDEX IF NOT EXISTS idx_name_party_alias"
+     " ON ofac_party_name(party_id, REPLACE(LOWER(name_type_cd),'.',''), name_text)"),
+    ("idx_addr_party",
+     "CREATE INDEX IF NOT EXISTS idx_addr_party ON ofac_party_address(party_id)"),
+    ("idx_attr_party",
+     "CREATE INDEX IF NOT EXISTS idx_attr_party"
+     " ON ofac_party_attribute(party_id, attribute_type_cd)"),
+    # match=prefix 検索用 (NOCASE の B-tree で LIKE 'q%' を範囲検索にする)
+    ("idx_search_value_nocase",
+     "CREATE INDEX IF NOT EXISTS idx_search_value_nocase"
+     " ON ofac_party_search(match_value COLLATE NOCASE)"),
+)
 
-# ──────────────────────────────────────────────
-# 個別パーティ詳細取得
-# ──────────────────────────────────────────────
 
-def get_party_data(party_id: int) -> Optional[Dict[str, Any]]:
+def _ensure_indexes(conn: sqlite3.Connection) -> None:
+    """不足しているインデックスを作成し、作成した場合のみ ANALYZE で統計を更新する"""
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    missing = [ddl for name, ddl in SCHEMA_INDEXES if name not in existing]
+    if not missing:
+        return
+
+    try:
+        for ddl in missing:
+            conn.execute(ddl)
+        conn.execute("ANALYZE")
+    except sqlite3.OperationalError as e:
+        # 読み取り専用で配置された DB などはインデックス無しのまま続行する
+        logger.warning("インデックスを作成できませんでした: %s", e)
+        return
+    logger.info("インデックスを作成しました: %d 件", len(missing))
+
+
+# 統合検索用のテーブルと全文検索インデックス (FTS5)
+#   name / alias / address の UNION を起動時に ofac_party_search へ実体化し、
+#   ofac_search_idx はその外部コンテンツとして本文のみを索引する。
+#   UNION の結果の指紋を ofac_party_search_meta に残し、指紋が食い違えば作り直す
+_SEARCH_SOURCE_SQL = """
+    -- name
+    SELECT n.party_id, 'name', n.name_text
+      FROM ofac_party_name n
+     WHERE n.is_primary_flg = 1 AND n.name_type_cd = 'FORMAL'
+    UNION ALL
+    -- alias
+    SELECT n2.party_id, 'alias', n2.name_text
+      FROM ofac_party_name n2
+     WHERE REPLACE(LOWER(n2.name_type_cd),'.','') = 'aka'
+    UNION ALL
+    -- address
+    SELECT ad.party_id, 'address',
+           COALESCE(ad.address_line,'') || ' ' || COALESCE(ad.city,'') || ' ' || COALESCE(ad.country_cd,'')
+      FROM ofac_party_address ad
+"""
+
+_SEARCH_INDEX_DDL = (
+    "DROP TABLE IF EXISTS ofac_search_idx",
+    "DROP TABLE IF EXISTS ofac_party_search",
+    "DROP TABLE IF EXISTS ofac_party_search_meta",
+    """
+    CREATE TABLE ofac_party_search (
+        search_id   INTEGER PRIMARY KEY,
+        party_id    INTEGER,
+        match_field TEXT,
+        match_value TEXT
+    )
+    """,
+    "INSERT INTO ofac_party_search (party_id, match_field, match_value)" + _SEARCH_SOURCE_SQL,
+    """
+    CREATE VIRTUAL TABLE ofac_search_idx USING fts5(
+        match_value,
+        content = 'ofac_party_search',
+        content_rowid = 'search_id',
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    """,
+    "INSERT INTO ofac_search_idx (ofac_search_idx) VALUES ('rebuild')",
+    "CREATE TABLE ofac_party_search_meta (fingerprint TEXT NOT NULL)",
+)
+
+
+def _search_source_fingerprint(conn: sqlite3.Connection) -> str:
+    """検索テーブルに入る行 (_SEARCH_SOURCE_SQL の結果) のハッシュを返す
+
+    件数や文字数の集計では同じ長さへの書き換えを見逃すため、行の中身をそのままハッシュする
+    (同梱 DB で 0.1 秒弱)。
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    cur = conn.execute(_SEARCH_SOURCE_SQL)
+    while rows := cur.fetchmany(4096):
+        digest.update(orjson.dumps(rows))
+    return digest.hexdigest()
+
+
+def _stored_search_fingerprint(conn: sqlite3.Connection) -> Optional[str]:
+    """検索テーブル作成時の指紋を返す (未作成 / 旧形式なら None)"""
+    try:
+        row = conn.execute("SELECT fingerprint FROM ofac_party_search_meta").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def _ensure_search_index(conn: sqlite3.Connection) -> None:
+    """検索テーブル / 全文検索インデックスが無いか、元データと食い違っていれば作り直す
+
+    作り直せない場合 (読み取り専用など) は RuntimeError を送出する。
+    """
+    if _stored_search_fingerprint(conn) == _search_source_fingerprint(conn):
+        return
+
+    try:
+        # 書き込みロックを取ってから指紋を取り直す (他のワーカーが作り直し済みなら何もしない)
+        conn.execute("BEGIN IMMEDIATE")
+        fingerprint = _search_source_fingerprint(conn)
+        if _stored_search_fingerprint(conn) == fingerprint:
+            conn.execute("COMMIT")
+            return
+        for stmt in _SEARCH_INDEX_DDL:
+            conn.execute(stmt)
+        conn.execute("INSERT INTO ofac_party_search_meta (fingerprint) VALUES (?)", (fingerprint,))
+        conn.execute("COMMIT")
+    except sqlite3.OperationalError as e:
+        if conn.in_transaction:
+            conn.rollback()
+        # 検索テーブルが無い / 古いまま起動すると検索結果が元データと食い違うため起動を止める
+        # (読み取り専用で配置する場合は、作成済みの DB を置く)
+        raise RuntimeError(f"全文検索インデックスを作成できません: {e}") from e
+    logger.info("全文検索インデックスを作成しました")
+
+
+def _init_db() -> None:
+    """DB ファイルの存在確認とスキーマ補完を行う (起動時と DB 更新の検知時)"""
     if not DB_FILE.exists():
         logger.error("DBファイルが見つかりません: %s", DB_FILE)
-        return {"error": f"DB ファイル {DB_FILE} が見つかりません。"}
+        return
+
+    conn = sqlite3.connect(DB_FILE, isolation_level=None)
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _ensure_search_index(conn)
+        _ensure_indexes(conn)
+    finally:
+        conn.close()
 
-    logger.info("パーティデータの取得: party_id=%s", party_id)
-    conn = sqlite3.connect(DB_FILE)
 
-    details_sql = """
+def _open_connection() -> sqlite3.Connection:
+    """PRAGMA 適用済みの読み取り用接続を開く
+
+    mode=rw で開くため、DB ファイルが無い場合は空の DB を作らずに
+    sqlite3.OperationalError となる (エラーハンドラで 500 を返す)。
+    """
+    conn = sqlite3.connect(
+        f"file:{DB_FILE.as_posix()}?mode=rw", uri=True, isolation_level=None, cached_statements=256
+    )
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+_init_db()
+_local = threading.local()
+
+
+def _db_inode() -> Optional[int]:
+    """DB ファイルの inode (ファイルが無ければ None)"""
+    try:
+        return DB_FILE.stat().st_ino
+    except OSError:
+        return None
+
+
+def get_conn() -> sqlite3.Connection:
+    """呼び出し元スレッド専用の接続を返す (初回のみ接続を開く)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # 開く前に inode を控えておき、直後に入れ替えられても次の確認で気付けるようにする
+        inode = _db_inode()
+        conn = _local.conn = _open_connection()
+        _local.db_state = (inode, conn.execute("PRAGMA data_version").fetchone()[0])
+    return conn
+
+# ──────────────────────────────────────────────
+# 個別パーティ詳細取得
+# ──────────────────────────────────────────────
+
+# details / identifications / aliases / addresses を 1 クエリで取得する。
+# 各セクションは JSON1 の json_object / json_group_array で 1 列に畳み込む。
+# 文字列を固定しておくことで sqlite3 の statement cache がそのまま効く。
+_PARTY_SQL = """
+WITH d AS (
     SELECT 
         p.party_type_cd             AS "Type",
         n.name_text                 AS "Entity Name",
@@ -80,51 +319,309 @@ def get_party_data(party_id: int) -> Optional[Dict[str, Any]]:
     JOIN ofac_code_master cm_list   ON ll.list_cd   = cm_list.code_id
     LEFT JOIN ofac_party_program_link pl ON p.party_id = pl.party_id
     LEFT JOIN ofac_code_master cm_prog   ON pl.program_cd = cm_prog.code_id
-    WHERE p.party_id = ?
-    GROUP BY p.party_id;
-    """
-    details_df = query_to_df(conn, details_sql, (party_id,))
-    if details_df.empty:
-        conn.close()
-        return None
-
-    ident_df = query_to_df(conn, """
+    WHERE p.party_id = :party_id
+    GROUP BY p.party_id
+),
+i AS (
     SELECT attribute_type_cd AS "Type", attribute_value AS "ID / Information"
       FROM ofac_party_attribute
-     WHERE party_id = ?
+     WHERE party_id = :party_id
        AND attribute_type_cd IN ('Website', 'Additional Sanctions Information -')
-     ORDER BY attribute_type_cd, attribute_value;
-    """, (party_id,))
-
-    alias_df = query_to_df(conn, """
+     ORDER BY attribute_type_cd, attribute_value
+),
+a AS (
     SELECT 'a.k.a.' AS "Type", 'weak' AS "Category", name_text AS "Name"
       FROM ofac_party_name
-     WHERE party_id = ?
+     WHERE party_id = :party_id
        AND REPLACE(LOWER(name_type_cd),'.','') = 'aka'
-     ORDER BY name_text;
-    """, (party_id,))
-
-    addr_df = query_to_df(conn, """
+     ORDER BY name_text
+),
+ad AS (
     SELECT address_line AS "Address", city AS "City", '' AS "State / Province",
            postal_code AS "Postal Code", cm.code_value AS "Country"
       FROM ofac_party_address ad
       LEFT JOIN ofac_code_master cm ON ad.country_cd = cm.code_id
-     WHERE ad.party_id = ?;
-    """, (party_id,))
+     WHERE ad.party_id = :party_id
+)
+SELECT
+    (SELECT json_object('Type', "Type", 'Entity Name', "Entity Name", 'List', "List",
+                        'Program', "Program", 'Remarks', "Remarks")
+       FROM d) AS details,
+    (SELECT json_group_array(json_object('Type', "Type", 'ID / Information', "ID / Information"))
+       FROM i) AS identifications,
+    (SELECT json_group_array(json_object('Type', "Type", 'Category', "Category", 'Name', "Name"))
+       FROM a) AS aliases,
+    (SELECT json_group_array(json_object('Address', "Address", 'City', "City",
+                                         'State / Province', "State / Province",
+                                         'Postal Code', "Postal Code", 'Country', "Country"))
+       FROM ad) AS addresses;
+"""
+
 
-    conn.close()
+# OFAC データは更新されるまで不変なので、取得結果 (JSON 文字列のタプル) を
+# プロセス内でキャッシュする。DB の更新を検知した時点で破棄する (_refresh_if_db_changed)。
+PARTY_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=PARTY_CACHE_SIZE)
+def _fetch_party_json(party_id: int) -> Optional[Tuple[str, str, str, str]]:
+    """details / identifications / aliases / addresses の JSON 文字列を返す (無ければ None)"""
+    row = get_conn().execute(_PARTY_SQL, {"party_id": party_id}).fetchone()
+    return None if row[0] is None else row
+
+
+def _party_from_json(details: str, identifications: str, aliases: str, addresses: str) -> Dict[str, Any]:
     return {
-        "details": details_df.to_dict(orient="records")[0],
-        "identifications": ident_df.to_dict(orient="records"),
-        "aliases": alias_df.to_dict(orient="records"),
-        "addresses": addr_df.to_dict(orient="records")
+        "details": orjson.loads(details),
+        "identifications": orjson.loads(identifications),
+        "aliases": orjson.loads(aliases),
+        "addresses": orjson.loads(addresses)
     }
 
+
+def get_party_data(party_id: int) -> Optional[Dict[str, Any]]:
+    logger.debug("パーティデータの取得: party_id=%s", party_id)
+
+    row = _fetch_party_json(party_id)
+    if row is None:
+        return None
+
+    return _party_from_json(*row)
+
+# ──────────────────────────────────────────────
+# 複数パーティ一括取得
+# ──────────────────────────────────────────────
+# ID 一覧を JSON 配列で渡し、json_each で展開して 1 クエリで取得する。
+# IN (?, ?, ...) と違い SQL 文字列が件数に依存しないため statement cache も効く。
+
+MAX_BATCH_IDS = 500
+
+_PARTY_BATCH_SQL = """
+WITH ids AS (
+    SELECT DISTINCT CAST(value AS INTEGER) AS party_id FROM json_each(:ids)
+)
+SELECT
+    ids.party_id,
+    (SELECT json_object('Type', p.party_type_cd, 'Entity Name', n.name_text, 'List', cm_list.code_value,
+                        'Program', GROUP_CONCAT(cm_prog.code_value, '; '), 'Remarks', COALESCE(p.remarks,''))
+       FROM ofac_sanctioned_party p
+       JOIN ofac_party_name n
+             ON p.party_id = n.party_id
+            AND n.is_primary_flg = 1
+            AND n.name_type_cd = 'FORMAL'
+       JOIN ofac_party_list_link ll    ON p.party_id = ll.party_id
+       JOIN ofac_code_master cm_list   ON ll.list_cd   = cm_list.code_id
+       LEFT JOIN ofac_party_program_link pl ON p.party_id = pl.party_id
+       LEFT JOIN ofac_code_master cm_prog   ON pl.program_cd = cm_prog.code_id
+      WHERE p.party_id = ids.party_id
+      GROUP BY p.party_id) AS details,
+    (SELECT json_group_array(json_object('Type', "Type", 'ID / Information', "ID / Information"))
+       FROM (SELECT attribute_type_cd AS "Type", attribute_value AS "ID / Information"
+               FROM ofac_party_attribute
+              WHERE party_id = ids.party_id
+                AND attribute_type_cd IN ('Website', 'Additional Sanctions Information -')
+              ORDER BY attribute_type_cd, attribute_value)) AS identifications,
+    (SELECT json_group_array(json_object('Type', 'a.k.a.', 'Category', 'weak', 'Name', name_text))
+       FROM (SELECT name_text
+               FROM ofac_party_name
+              WHERE party_id = ids.party_id
+                AND REPLACE(LOWER(name_type_cd),'.','') = 'aka'
+              ORDER BY name_text)) AS aliases,
+    (SELECT json_group_array(json_object('Address', ad.address_line, 'City', ad.city, 'State / Province', '',
+                                         'Postal Code', ad.postal_code, 'Country', cm.code_value))
+       FROM ofac_party_address ad
+       LEFT JOIN ofac_code_master cm ON ad.country_cd = cm.code_id
+      WHERE ad.party_id = ids.party_id) AS addresses
+  FROM ids;
+"""
+
+
+def get_party_data_batch(party_ids: List[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+    """複数パーティの詳細を 1 クエリで取得する (見つからない ID は None)"""
+    logger.debug("パーティデータの一括取得: %d 件", len(party_ids))
+
+    rows = get_conn().execute(
+        _PARTY_BATCH_SQL, {"ids": orjson.dumps(party_ids).decode()}
+    ).fetchall()
+    found = {
+        row[0]: _party_from_json(*row[1:])
+        for row in rows
+        if row[1] is not None
+    }
+    return {party_id: found.get(party_id) for party_id in party_ids}
+
+# ──────────────────────────────────────────────
+# 軽量版パーティ取得 (スキャナ向け)
+# ──────────────────────────────────────────────
+# リスト / プログラム / 住所などの結合を行わず、種別と正式名称だけを返す。
+
+_PARTY_LITE_SQL = """
+SELECT p.party_type_cd AS "Type",
+       n.name_text     AS "Entity Name"
+  FROM ofac_sanctioned_party p
+  JOIN ofac_party_name n
+        ON p.party_id = n.party_id
+       AND n.is_primary_flg = 1
+       AND n.name_type_cd = 'FORMAL'
+ WHERE p.party_id = ?;
+"""
+
+
+@functools.lru_cache(maxsize=PARTY_CACHE_SIZE)
+def _fetch_party_lite(party_id: int) -> Optional[Tuple[str, str]]:
+    """(Type, Entity Name) を返す (無ければ None)"""
+    return get_conn().execute(_PARTY_LITE_SQL, (party_id,)).fetchone()
+
+
+def get_party_lite(party_id: int) -> Optional[Dict[str, Any]]:
+    logger.debug("軽量パーティデータの取得: party_id=%s", party_id)
+
+    row = _fetch_party_lite(party_id)
+    if row is None:
+        return None
+
+    party_type, name = row
+    return {"party_id": party_id, "Type": party_type, "Entity Name": name}
+
 # ──────────────────────────────────────────────
 # 検索ロジック (統合)
 # ──────────────────────────────────────────────
 
-ALLOWED_SCOPES = {"all", "name", "alias", "address"}
+ALLOWED_SCOPES = frozenset({"all", "name", "alias", "address"})
+ALLOWED_MATCH_MODES = frozenset({"contains", "prefix"})
+
+# エラーメッセージは固定なので起動時に 1 回だけ組み立てる
+_SCOPE_ERROR_MSG = f"scope は {', '.join(sorted(ALLOWED_SCOPES))} のいずれかで指定してください"
+_MATCH_ERROR_MSG = f"match は {', '.join(sorted(ALLOWED_MATCH_MODES))} のいずれかで指定してください"
+
+
+@functools.lru_cache(maxsize=None)
+def _build_search_sql(prefix: bool, by_scope: bool, by_country: bool, by_city: bool) -> str:
+    """統合検索 SQL を組み立てる
+
+    WHERE 句は一致方式と条件の有無だけで決まるため、組み合わせ (最大 16 通り) 毎に
+    同一文字列を返し、sqlite3 の statement cache で再利用させる。
+    """
+    if prefix:
+        # 前方一致: NOCASE インデックスの範囲検索 (スコアが無いため名称順)
+        from_sql = "ofac_party_search ps"
+        rank_sql = "0"
+        where_clauses = ["ps.match_value LIKE :match ESCAPE '\\'"]
+    else:
+        # 部分一致: FTS5 の MATCH (bm25 スコア順)
+        from_sql = "ofac_search_idx\n          JOIN ofac_party_search ps ON ps.search_id = ofac_search_idx.rowid"
+        rank_sql = "MIN(ofac_search_idx.rank)"
+        where_clauses = ["ofac_search_idx MATCH :match"]
+
+    # 動的 WHERE 条件 (いずれも LIMIT 前の matched 側で絞り込む)
+
+    if by_scope:
+        where_clauses.append("ps.match_field = :scope")
+
+    addr_clauses: List[str] = []
+    if by_country:
+        addr_clauses.append("(lower(ad.country_cd) = lower(:country) OR lower(cm_country.code_value) = lower(:country))")
+    if by_city:
+        addr_clauses.append("lower(ad.city) = lower(:city)")
+    if addr_clauses:
+        where_clauses.append(f"""EXISTS (
+            SELECT 1
+              FROM ofac_party_address ad
+              LEFT JOIN ofac_code_master cm_country ON ad.country_cd = cm_country.code_id
+             WHERE ad.party_id = ps.party_id
+               AND {' AND '.join(addr_clauses)}
+        )""")
+
+    # 一覧 (list_link) に載っていないパーティは結果に出ないため、LIMIT 前に除外しておく
+    where_clauses.append(
+        "EXISTS (SELECT 1 FROM ofac_party_list_link ll WHERE ll.party_id = ps.party_id)"
+    )
+
+    where_sql = "\n       AND ".join(where_clauses)
+
+    # SQL 組み立て
+    #   matched で一致行を (party, field, value) 単位に絞り、スコア → 名称順で LIMIT してから
+    #   一覧・プログラムを結合する (結合による行の膨張は LIMIT 後の少数行だけ)
+    return f"""
+    WITH matched AS (
+        SELECT ps.party_id, ps.match_field, ps.match_value, pn.name_text,
+               {rank_sql} AS rank
+          FROM {from_sql}
+          JOIN ofac_party_name pn   ON pn.party_id = ps.party_id
+                                   AND pn.is_primary_flg = 1
+                                   AND pn.name_type_cd = 'FORMAL'
+         WHERE {where_sql}
+         GROUP BY ps.party_id, ps.match_field, ps.match_value, pn.name_text
+         ORDER BY rank, pn.name_text
+         LIMIT :limit
+    )
+    SELECT m.party_id,
+           m.name_text               AS "Entity Name",
+           p.party_type_cd           AS "Type",
+           cm_list.code_value        AS "List",
+           (SELECT GROUP_CONCAT(cm_prog.code_value,'; ')
+              FROM ofac_party_program_link pl
+              JOIN ofac_code_master cm_prog ON pl.program_cd = cm_prog.code_id
+             WHERE pl.party_id = m.party_id) AS "Program",
+           m.match_field             AS matchField,
+           m.match_value             AS matchValue
+      FROM matched m
+      JOIN ofac_sanctioned_party p       ON p.party_id = m.party_id
+      JOIN ofac_party_list_link ll       ON p.party_id = ll.party_id
+      JOIN ofac_code_master cm_list      ON ll.list_cd  = cm_list.code_id
+     ORDER BY m.rank, m.name_text
+     LIMIT :limit;
+    """
+
+
+def _to_fts_query(q: str) -> Optional[str]:
+    """検索語を FTS5 の MATCH 式に変換する (各トークンの前方一致を AND で結合)
+
+    語として扱える文字が無い場合は None を返す。
+    """
+    tokens = re.findall(r"\w+", q)
+    if not tokens:
+        return None
+    return " ".join(f'"{t}"*' for t in tokens)
+
+
+def _to_prefix_pattern(q: str) -> str:
+    """検索語を前方一致の LIKE パターンに変換する (% _ \\ はエスケープ)"""
+    return re.sub(r"([%_\\])", r"\\\1", q) + "%"
+
+
+# 同一条件の検索結果もパーティ取得と同様にキャッシュする (DB 更新の検知時に破棄)。
+# 1 件あたり最大 1000 行になり得るため件数は控えめにしている。
+SEARCH_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def _search_rows(
+    prefix: bool,
+    match_expr: str,
+    scope: str,
+    country: Optional[str],
+    city: Optional[str],
+    limit: int
+) -> Tuple[Tuple[str, ...], Tuple[tuple, ...]]:
+    """検索を実行し (列名, 行) を返す"""
+    # 名前付きパラメータ (SQL 側で使われないものは無視される)
+    params = {
+        "match": match_expr,
+        "scope": scope,
+        "country": country,
+        "city": city,
+        "limit": limit,
+    }
+
+    sql = _build_search_sql(prefix, scope != "all", bool(country), bool(city))
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("統合検索 SQL: %s", sql)
+        logger.debug("params: %s", params)
+
+    cur = get_conn().execute(sql, params)
+    return tuple(c[0] for c in cur.description), tuple(cur.fetchall())
 
 
 def search_party_advanced(
@@ -133,125 +630,158 @@ def search_party_advanced(
     country: Optional[str] = None,
     city: Optional[str] = None,
     limit: int = 100,
-    fuzzy: bool = False
+    fuzzy: bool = False,
+    match: str = "contains"
 ) -> List[Dict[str, Any]]:
-    """alias / address を含む統合検索 (LIKE ベース)"""
-    if not DB_FILE.exists():
-        logger.error("DBファイルが見つかりません: %s", DB_FILE)
-        return {"error": f"DB ファイル {DB_FILE} が見つかりません。"}
-
+    """alias / address を含む統合検索 (contains: FTS5 / prefix: 前方一致)"""
     # パラメータ前処理
     scope = scope.lower()
     if scope not in ALLOWED_SCOPES:
-        raise ValueError(f"scope は {', '.join(ALLOWED_SCOPES)} のいずれかで指定してください")
+        raise ValueError(_SCOPE_ERROR_MSG)
+    match = match.lower()
+    if match not in ALLOWED_MATCH_MODES:
+        raise ValueError(_MATCH_ERROR_MSG)
     limit = max(1, min(limit, 1000))  # clamp to 1–1000
 
-    pattern = f"%{q}%"  # LIKE パターン
+    prefix = match == "prefix"
+    if prefix:
+        match_expr = _to_prefix_pattern(q)  # LIKE パターン
+    else:
+        match_expr = _to_fts_query(q)  # MATCH 式
+        if match_expr is None:
+            return []
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.create_function("lower", 1, lambda s: s.lower() if s else None)
+    cols, rows = _search_rows(prefix, match_expr, scope, country, city, limit)
+    return [dict(zip(cols, row)) for row in rows]
 
-    # 動的 WHERE 条件
-    where_clauses = ["lower(s.match_value) LIKE lower(?)"]
-    params: List[Any] = [pattern]
+# ──────────────────────────────────────────────
+# Flask ルーティング
+# ──────────────────────────────────────────────
 
-    if scope != "all":
-        where_clauses.append("s.match_field = ?")
-        params.append(scope)
+# SQLite の INTEGER (64bit 符号付き) に収まる最大値
+_MAX_PARTY_ID = 2 ** 63 - 1
 
-    if country:
-        where_clauses.append("(lower(ad.country_cd) = lower(?) OR lower(cm_country.code_value) = lower(?))")
-        params.extend([country, country])
 
-    if city:
-        where_clauses.append("lower(ad.city) = lower(?)")
-        params.append(city)
+def _parse_party_id(value: Optional[str]) -> Optional[int]:
+    """ASCII の数字のみで SQLite の INTEGER に収まる場合だけ int を返す ('①' などは None)"""
+    if not value or not (value.isascii() and value.isdigit()):
+        return None
+    party_id = int(value)
+    return party_id if party_id <= _MAX_PARTY_ID else None
 
-    where_sql = " AND ".join(where_clauses)
 
-    # SQL 組み立て
-    sql = f"""
-    WITH union_search AS (
-        -- name
-        SELECT n.party_id, 'name' AS match_field, n.name_text AS match_value
-          FROM ofac_party_name n
-         WHERE n.is_primary_flg = 1 AND n.name_type_cd = 'FORMAL'
-        UNION ALL
-        -- alias
-        SELECT n2.party_id, 'alias', n2.name_text
-          FROM ofac_party_name n2
-         WHERE REPLACE(LOWER(n2.name_type_cd),'.','') = 'aka'
-        UNION ALL
-        -- address
-        SELECT ad.party_id, 'address',
-               COALESCE(ad.address_line,'') || ' ' || COALESCE(ad.city,'') || ' ' || COALESCE(ad.country_cd,'')
-          FROM ofac_party_address ad
-    )
-    SELECT DISTINCT p.party_id,
-           pn.name_text              AS "Entity Name",
-           p.party_type_cd           AS "Type",
-           cm_list.code_value        AS "List",
-           GROUP_CONCAT(cm_prog.code_value,'; ') AS "Program",
-           s.match_field             AS matchField,
-           s.match_value             AS matchValue
-      FROM union_search s
-      JOIN ofac_sanctioned_party p       ON p.party_id = s.party_id
-      JOIN ofac_party_name pn            ON pn.party_id = p.party_id
-                                        AND pn.is_primary_flg = 1
-                                        AND pn.name_type_cd = 'FORMAL'
-      JOIN ofac_party_list_link ll       ON p.party_id = ll.party_id
-      JOIN ofac_code_master cm_list      ON ll.list_cd  = cm_list.code_id
-      LEFT JOIN ofac_party_program_link pl  ON p.party_id = pl.party_id
-      LEFT JOIN ofac_code_master cm_prog    ON pl.program_cd = cm_prog.code_id
-      LEFT JOIN ofac_party_address ad       ON ad.party_id = p.party_id
-      LEFT JOIN ofac_code_master cm_country ON ad.country_cd = cm_country.code_id
-     WHERE {where_sql}
-     GROUP BY p.party_id, pn.name_text, p.party_type_cd, cm_list.code_value, s.match_field, s.match_value
-     ORDER BY pn.name_text
-     LIMIT ?;
-    """
+# 共通レスポンス: jsonify の引数解釈を通さず orjson で直接エンコードする
+def _ok(data: Any):
+    body = orjson.dumps({"resultCd": True, "data": data})
+    return app.response_class(body, mimetype="application/json")
 
-    params.append(limit)
 
-    logger.debug("統合検索 SQL: %s", sql)
-    logger.debug("params: %s", params)
+def _error(message: str, status: int):
+    body = orjson.dumps({"resultCd": False, "message": message})
+    return app.response_class(body, status=status, mimetype="application/json")
 
-    df = query_to_df(conn, sql, tuple(params))
-    conn.close()
 
-    # 空なら []
-    return df.to_dict(orient="records") if not df.empty else []
+_DB_ERROR_MSG = f"DB ファイル {DB_FILE} を読み取れません。"
 
-# ──────────────────────────────────────────────
-# Flask ルーティング
-# ──────────────────────────────────────────────
+# DB 更新の検知
+#   リクエスト毎に inode (ファイルの入れ替え) と PRAGMA data_version (他の接続 /
+#   プロセスによるコミット) を確認する。stat 1 回と PRAGMA 1 回なので十分に軽い。
+_refresh_lock = threading.Lock()
+_INDEX_ERROR_MSG = "全文検索インデックスを更新できません。"
+
+
+@app.before_request
+def _refresh_if_db_changed():
+    """DB の更新を検知したら、検索テーブル・接続・キャッシュを DB に揃え直す"""
+    conn = get_conn()
+    inode = _db_inode()
+    if inode != _local.db_state[0]:
+        # ファイルが入れ替えられた: 古い inode を読み続けないよう開き直す
+        conn.close()
+        _local.conn = None
+        conn = get_conn()
+    elif conn.execute("PRAGMA data_version").fetchone()[0] == _local.db_state[1]:
+        return None
+
+    with _refresh_lock:
+        try:
+            _init_db()  # 指紋が変わっていれば検索テーブルを作り直す (変わっていなければ何もしない)
+        except RuntimeError as e:
+            logger.error("%s", e)
+            return _error(_INDEX_ERROR_MSG, 503)
+        _fetch_party_json.cache_clear()
+        _fetch_party_lite.cache_clear()
+        _search_rows.cache_clear()
+    # 作り直し自体のコミットで data_version が進むため、最後に取り直す
+    _local.db_state = (inode, conn.execute("PRAGMA data_version").fetchone()[0])
+    logger.info("DB の更新を検知したため、キャッシュを破棄しました")
+    return None
+
+
+@app.errorhandler(sqlite3.Error)
+def handle_db_error(e: sqlite3.Error):
+    # DB ファイルの欠落・破損などはここでまとめて 500 にする
+    logger.error("DB エラー: %s", e)
+    return _error(_DB_ERROR_MSG, 500)
 
 @app.route("/ofacParty", methods=["GET"])
 def ofac_party():
     party_id_param = request.args.get("partyId")
-    logger.info("/ofacParty request: partyId=%s", party_id_param)
+    logger.debug("/ofacParty request: partyId=%s", party_id_param)
 
-    if not party_id_param or not party_id_param.isdigit():
-        return jsonify({"resultCd": False, "message": "partyId を数値で指定してください"}), 400
+    party_id = _parse_party_id(party_id_param)
+    if party_id is None:
+        return _error("partyId を数値で指定してください", 400)
 
-    party_id = int(party_id_param)
     result = get_party_data(party_id)
 
-    if isinstance(result, dict) and result.get("error"):
-        return jsonify({"resultCd": False, "message": result["error"]}), 500
     if result is None:
-        return jsonify({"resultCd": False, "message": f"party_id={party_id} のデータが見つかりません"}), 404
+        return _error(f"party_id={party_id} のデータが見つかりません", 404)
+
+    return _ok(result)
+
+@app.route("/ofacParty/batch", methods=["GET"])
+def ofac_party_batch():
+    ids_param = request.args.get("ids", "")
+    logger.debug("/ofacParty/batch request: ids=%s", ids_param)
+
+    id_params = [s.strip() for s in ids_param.split(",") if s.strip()]
+    if len(id_params) > MAX_BATCH_IDS:
+        return _error(f"ids は {MAX_BATCH_IDS} 件以内で指定してください", 400)
+    parsed = [_parse_party_id(s) for s in id_params]
+    if not parsed or None in parsed:
+        return _error("ids をカンマ区切りの数値で指定してください", 400)
+
+    party_ids = list(dict.fromkeys(parsed))  # 順序を保って重複除去
+    result = get_party_data_batch(party_ids)
+
+    return _ok({str(pid): data for pid, data in result.items()})
+
+@app.route("/ofacParty/lite", methods=["GET"])
+def ofac_party_lite():
+    party_id_param = request.args.get("partyId")
+    logger.debug("/ofacParty/lite request: partyId=%s", party_id_param)
+
+    party_id = _parse_party_id(party_id_param)
+    if party_id is None:
+        return _error("partyId を数値で指定してください", 400)
+
+    result = get_party_lite(party_id)
+
+    if result is None:
+        return _error(f"party_id={party_id} のデータが見つかりません", 404)
 
-    return jsonify({"resultCd": True, "data": result})
+    return _ok(result)
 
 @app.route("/ofacParty/search", methods=["GET"])
 def search_party():
     # q (新) or name (旧) のいずれか必須
-    q_param = request.args.get("q") or request.args.get("name")
-    if not q_param or len(q_param.strip()) < 2:
-        return jsonify({"resultCd": False, "message": "q または name パラメータを2文字以上で指定してください"}), 400
+    q_param = (request.args.get("q") or request.args.get("name") or "").strip()
+    if len(q_param) < 2:
+        return _error("q または name パラメータを2文字以上で指定してください", 400)
 
-    scope_param = (request.args.get("scope") or "all").lower()
+    # scope / match の小文字化と許可値チェックは search_party_advanced 側で 1 回だけ行う
+    scope_param = request.args.get("scope") or "all"
     country_param = request.args.get("country")
     city_param = request.args.get("city")
 
@@ -259,27 +789,26 @@ def search_party():
     try:
         limit_param = int(request.args.get("limit", 100))
     except ValueError:
-        return jsonify({"resultCd": False, "message": "limit パラメータは整数で指定してください"}), 400
+        return _error("limit パラメータは整数で指定してください", 400)
 
     fuzzy_param = request.args.get("fuzzy", "false").lower() == "true"
+    match_param = request.args.get("match") or "contains"
 
     # 検索実行
     try:
         result = search_party_advanced(
-            q=q_param.strip(),
+            q=q_param,
             scope=scope_param,
             country=country_param,
             city=city_param,
             limit=limit_param,
-            fuzzy=fuzzy_param
+            fuzzy=fuzzy_param,
+            match=match_param
         )
     except ValueError as e:
-        return jsonify({"resultCd": False, "message": str(e)}), 400
-
-    if isinstance(result, dict) and "error" in result:
-        return jsonify({"resultCd": False, "message": result["error"]}), 500
+        return _error(str(e), 400)
 
-    return jsonify({"resultCd": True, "data": result})
+    return _ok(result)
 
 # ──────────────────────────────────────────────
 # エントリポイント
@@ -287,17 +816,34 @@ def search_party():
 
 if __name__ == "__main__":
     import os
-    import asyncio
-    import hypercorn.asyncio
     from hypercorn.config import Config
+    from hypercorn.run import run
 
     # Render が注入する PORT（例: 8000）を取得。ローカル実行時は 10000 をデフォルトに
     port = int(os.getenv("PORT", "10000"))
 
+    if not DB_FILE.exists():
+        raise SystemExit(f"DB ファイル {DB_FILE} が見つかりません。")
+
     config = Config()
     config.bind = [f"0.0.0.0:{port}"]
-    config.workers = int(os.getenv("WORKERS", "1"))
     config.keep_alive_timeout = 65
-
-    logger.info("OFAC API サーバー起動: http://0.0.0.0:%d", port)
-    asyncio.run(hypercorn.asyncio.serve(app, config))
+    # ワーカーは spawn された別プロセスで "ofac_api:app" を読み込み直す。
+    # lru_cache (パーティ / 検索結果) と SQLite 接続はワーカーごとに独立しているが、
+    # 各ワーカーがリクエスト毎に DB の更新を検知して自分のキャッシュを破棄する
+    # (_refresh_if_db_changed)
+    config.application_path = "ofac_api:app"
+    config.workers = int(os.getenv("WEB_CONCURRENCY", os.getenv("WORKERS", str(os.cpu_count() or 2))))
+
+    # uvloop が入っていればイベントループに使う (Windows では未対応のため asyncio のまま)
+    try:
+        import uvloop  # noqa: F401
+        config.worker_class = "uvloop"
+    except ImportError:
+        config.worker_class = "asyncio"
+
+    logger.info(
+        "OFAC API サーバー起動: http://0.0.0.0:%d (workers=%d, worker_class=%s)",
+        port, config.workers, config.worker_class
+    )
+    raise SystemExit(run(config))